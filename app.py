@@ -2,37 +2,132 @@
 # Floww – AI-powered Mermaid Diagram Generator
 # =============================================
 
+import hashlib
+import html
+import json
 import os
-import re
+
 import streamlit as st
-from openai import OpenAI
+
+CACHE_DIR = ".floww_cache"
+CACHE_TTL = 86400  # seconds
+
+# The SDK retries 429/5xx/connection errors itself with exponential backoff
+OPENAI_MAX_RETRIES = 4
+OPENAI_TIMEOUT = 30.0  # seconds per attempt
+
+PERSONAS = ("Enterprise AE", "SMB SDR", "Partner Manager")
+DEFAULT_STAGES = (
+    "prospecting, qualification, research, discovery call, proposal, "
+    "negotiation, onboarding, post-sale engagement, upsell"
+)
+
+# Rendered client-side in one iframe; mermaid.js is only fetched when a diagram is shown.
+# Pinned to an exact release: the iframe has same-origin access to the app, so a
+# floating tag would run whatever minor release the CDN serves next.
+MERMAID_VERSION = "11.10.0"
+MERMAID_HTML = """
+<pre class="mermaid">{code}</pre>
+<script type="module">
+  import mermaid from "https://cdn.jsdelivr.net/npm/mermaid@{version}/dist/mermaid.esm.min.mjs";
+  mermaid.initialize({{ startOnLoad: false, securityLevel: "strict" }});
+  await mermaid.run();
+</script>
+"""
+
+# Refresh the streaming preview every N chunks (~tokens) rather than on each one
+STREAM_UPDATE_EVERY = 50
+
+# Completion budget: title/subgraph scaffolding plus one node and labelled edge per stage
+BASE_TOKENS = 100
+TOKENS_PER_STAGE = 30
 
 # ── UI Config ─────────────────────────────────────────────────
 st.set_page_config(page_title="Floww Mermaid", layout="wide")
 st.title("Floww – AI-powered Mermaid Diagram Generator")
-st.caption("Generate and render advanced Mermaid.js flowcharts via OpenAI")
+st.caption("Template Mermaid.js flowcharts locally, or have OpenAI style them")
 
 # ── OpenAI Client ───────────────────────────────────────────
+# Only needed for AI styling; the local template works without a key
 api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    st.error("Missing OPENAI_API_KEY environment variable.")
-    st.stop()
-client = OpenAI(api_key=api_key)
+
+
+@st.cache_resource
+def get_openai_client():
+    # Imported here so page loads don't pay for the OpenAI SDK
+    from openai import OpenAI
+    return OpenAI(api_key=api_key, max_retries=OPENAI_MAX_RETRIES, timeout=OPENAI_TIMEOUT)
+
+
+# ── Response Cache ──────────────────────────────────────────
+@st.cache_resource
+def get_response_cache():
+    import diskcache
+    return diskcache.Cache(CACHE_DIR)
+
+
+def cached_completion(model, system, user, on_text=None, **params):
+    """Return ``(text, finish_reason)``, reusing a disk-cached copy for identical requests.
+
+    On a cache miss the response is streamed; ``on_text`` (if given) is called
+    with the text received so far every ``STREAM_UPDATE_EVERY`` chunks and once
+    more when the stream ends. Only complete answers are cached, so a cache hit
+    reports ``"stop"``.
+    """
+    cache = get_response_cache()
+    payload = json.dumps([model, system, user, params], sort_keys=True)
+    key = hashlib.blake2b(payload.encode()).hexdigest()
+    content = cache.get(key)
+    finish_reason = "stop"
+    if content is None:
+        stream = get_openai_client().chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system",  "content": system},
+                {"role": "user",    "content": user},
+            ],
+            stream=True,
+            **params,
+        )
+        content = ""
+        finish_reason = None
+        received = 0
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            content += choice.delta.content or ""
+            finish_reason = choice.finish_reason or finish_reason
+            received += 1
+            if on_text and received % STREAM_UPDATE_EVERY == 0:
+                on_text(content)
+        if on_text:
+            on_text(content)
+        # Only cache complete answers; a response cut off by max_tokens is
+        # returned once but not replayed for the rest of the TTL
+        if finish_reason == "stop":
+            cache.set(key, content, expire=CACHE_TTL)
+    return content, finish_reason
+
 
 # ── Sidebar Inputs ──────────────────────────────────────────
 st.sidebar.header("Mermaid Diagram Options")
-company     = st.sidebar.text_input("Company name", "Acme Corp")
-persona     = st.sidebar.selectbox("Persona", ["Enterprise AE", "SMB SDR", "Partner Manager"])
-stages_text = st.sidebar.text_area(
-    "Workflow stages (comma-separated)",
-    "prospecting, qualification, research, discovery call, proposal, negotiation, onboarding, post-sale engagement, upsell"
+company = st.sidebar.text_input("Company name", "Acme Corp")
+persona = st.sidebar.selectbox("Persona", PERSONAS)
+stages_text = st.sidebar.text_area("Workflow stages (comma-separated)", DEFAULT_STAGES)
+use_ai = st.sidebar.checkbox(
+    "Use AI diagram styling", False,
+    help="Tick to have OpenAI add subgraphs, swimlanes and arrow labels. "
+         "Otherwise a plain flowchart is templated locally, without an API call.",
 )
 
 # ── Mermaid Prompt Templates ─────────────────────────────────
-mermaid_sys = (
+# The system prompt is fully static so OpenAI can reuse its cached prefix;
+# per-request values belong in the user message only.
+MERMAID_SYS = (
     "You are a sales operations architect and diagram expert. "
     "Output **only** a Mermaid.js flowchart snippet—no markdown fences or commentary—meeting these requirements:\n"
-    "1. Title the chart \"Floww Workflow for {company}\".\n"
+    "1. Title the chart \"Floww Workflow for <company>\", using the company named by the user.\n"
     "2. Group the workflow into three subgraphs:\n"
     "   - Pre-Sales: prospecting, qualification, research\n"
     "   - Sales: discovery call, proposal, negotiation\n"
@@ -41,34 +136,84 @@ mermaid_sys = (
     "4. Label each arrow with the key action (e.g., Outbound Email, Demo Call, Contract Review).\n"
     "5. Lay out the chart top-to-bottom.\n"
     "Keep it concise."
-).format(company=company)
+)
+
+
+def build_mermaid(company, stages):
+    """Template a plain top-to-bottom Mermaid flowchart from the stage list."""
+    labels = [s.replace('"', "'") for s in stages]
+    # JSON strings are valid YAML scalars, so ": " / " #" in the name stay literal
+    title = json.dumps(f"Floww Workflow for {company}")
+    lines = ["---", f"title: {title}", "---", "flowchart TB"]
+    if len(labels) == 1:
+        lines.append(f'    S0["{labels[0]}"]')
+    lines += [f'    S{i}["{a}"] --> S{i + 1}["{b}"]' for i, (a, b) in enumerate(zip(labels, labels[1:]))]
+    return "\n".join(lines)
+
 
 # ── Generate Mermaid Diagram ─────────────────────────────────
-if st.sidebar.button("Generate Mermaid Diagram"):
-    # Prepare the user message
-    mermaid_usr = f"Here are the stages: {stages_text}."
-
-    # Call OpenAI
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system",  "content": mermaid_sys},
-            {"role": "user",    "content": mermaid_usr},
-        ],
-        temperature=0.0,
-        max_tokens=300,
-    )
+# The last result is kept in session state so unrelated reruns (or a repeat
+# click with the same inputs) redisplay it without regenerating. Inputs are
+# normalised first so spacing/empty-entry variants share one cache entry.
+company_name = company.strip()
+stages = tuple(s.strip() for s in stages_text.split(",") if s.strip())
+inputs_key = (company_name, stages, use_ai)
+generated = st.session_state.get("mermaid")
+
+generate = st.sidebar.button("Generate Mermaid Diagram")
+
+if generate and not stages:
+    st.warning("Enter at least one workflow stage to generate a diagram.")
+elif generate and use_ai and not api_key:
+    st.error("Missing OPENAI_API_KEY environment variable.")
+elif generate and (generated is None or generated["key"] != inputs_key):
+    if use_ai:
+        # Prepare the user message
+        mermaid_usr = f"Company: {company_name}\nHere are the stages: {', '.join(stages)}."
 
-    # Extract and clean up the Mermaid code
-    raw = resp.choices[0].message.content.strip()
-    mermaid_code = re.sub(r"^```mermaid|```$", "", raw, flags=re.M)
+        # Call OpenAI (or reuse a cached response for the same prompt),
+        # previewing the code while it streams in
+        preview = st.empty()
+        raw, finish_reason = cached_completion(
+            "gpt-4o-mini",
+            MERMAID_SYS,
+            mermaid_usr,
+            on_text=lambda text: preview.code(text, language=""),
+            temperature=0.0,
+            max_tokens=BASE_TOKENS + TOKENS_PER_STAGE * len(stages),
+            stop=["\n```"],  # anything after a closing fence is discarded anyway
+        )
+        preview.empty()
+
+        if finish_reason == "length":
+            # A flowchart cut off by max_tokens only renders as a syntax error
+            mermaid_code = None
+            st.warning("The diagram was cut off before it finished; try fewer stages.")
+        else:
+            # Strip any ``` fences the model wrapped around the snippet despite instructions
+            mermaid_code = raw.strip().removeprefix("```mermaid").removeprefix("```").removesuffix("```").strip()
+    else:
+        mermaid_code = build_mermaid(company_name, stages)
+    if mermaid_code is not None:
+        generated = st.session_state["mermaid"] = {"key": inputs_key, "code": mermaid_code}
+
+# ── Display ─────────────────────────────────────────────────
+if generated is not None and generated["key"] == inputs_key:
+    mermaid_code = generated["code"]
 
-    # Display
     st.subheader("Mermaid Diagram Code")
     st.code(mermaid_code, language="")
 
     st.subheader("Rendered Mermaid Diagram")
-    st.markdown(f"```mermaid\n{mermaid_code}\n```", unsafe_allow_html=True)
+    # Escaped so the model's output is only ever read as diagram text by mermaid.js.
+    # The frame is same-origin with the app (srcdoc), which height="content" needs;
+    # a data: URL would isolate it but pin the height at 400px. What remains is
+    # trusting mermaid's strict mode: a sanitiser bug in MERMAID_VERSION would let
+    # a crafted diagram run script with access to the app's page.
+    st.iframe(
+        MERMAID_HTML.format(code=html.escape(mermaid_code), version=MERMAID_VERSION),
+        height="content",
+    )
 
 # ── Footer ─────────────────────────────────────────────────
 st.sidebar.markdown("---")